@@ -3,15 +3,27 @@ Extracts and structures Optical Fibre Cabling (OFC) data
 from the Bruhat Bengaluru Mahanagara Palike (BBMP)
 """
 
+import asyncio
 import csv
 import json
 import logging
 import os
+from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import geopandas as gpd
+import httpx
 import imageio
+import numpy as np
+import orjson
+import pandas as pd
 from matplotlib import pyplot as plt
+from shapely.geometry import LineString
+
+# Go through pyogrio rather than Fiona for any remaining GDAL reads/writes
+gpd.options.io_engine = "pyogrio"
 
 headers = {
     'Connection': 'keep-alive',
@@ -20,19 +32,35 @@ headers = {
     'Referer': 'http://bbmp.oasisweb.in/RoadHistory/CitizenView/CitizenViewDemo.aspx'
 }
 
+# Format of ApplicationsubmittedDate as served by the BBMP
+_SUBMITTED_FMT = '%m/%d/%Y %I:%M:%S %p'
+
+def get_session():
+
+	"""
+	A keep-alive session so repeated requests to the BBMP server reuse one connection.
+	"""
+
+	session = requests.Session()
+	session.headers.update(headers)
+
+	adapter = HTTPAdapter(
+		pool_connections=2,
+		pool_maxsize=16,
+		max_retries=Retry(total=3, backoff_factor=0.5)
+	)
+	session.mount('http://', adapter)
+
+	return session
+
 def write_to_csv(list_of_dicts, filename):
 	
-	keys = list_of_dicts[0].keys()
-	
-	with open(filename, 'w', newline='') as f:
-		dict_writer = csv.DictWriter(f, keys)
-		dict_writer.writeheader()
-		dict_writer.writerows(list_of_dicts)
+	pd.DataFrame(list_of_dicts).to_csv(filename, index=False)
 
 def clean_data_derive_insights(path_to_full_data):
 
 	"""
-	The final GeoJSON can be made better by:
+	The behemoth GeoParquet can be made better by:
 		1. Removing duplicates
 		2. Assigning a company to the email addresses
 
@@ -72,18 +100,20 @@ def clean_data_derive_insights(path_to_full_data):
 		"actcorp.in": "ACT Fibernet"
 	}
 
-	def parse_email_domain(row):
+	# Companies as a categorical so grouping and filtering work on integer codes
+	company_dtype = pd.CategoricalDtype(categories=list(dict.fromkeys(email_mappings.values())))
 
-		email_id = row['application_email_id']
+	def map_email_to_company(email_ids):
 
-		try:
-			domain = email_id.split('@')[1]
-			company = email_mappings[domain]
-			return company
-		except:
-			return None
+		"""
+		Maps a Series of email addresses to companies via their domain.
+		Malformed emails and unknown domains come out as NaN, no exceptions raised.
+		"""
 
-	def generate_spread_gif(path_to_gpkg):
+		domain = email_ids.str.split('@', n=1).str[1].str.lower()
+		return domain.map(email_mappings).astype(company_dtype)
+
+	def generate_spread_gif(gdf_spread):
 
 		"""
 		Helper function to spin up the GIF on the repo
@@ -92,41 +122,66 @@ def clean_data_derive_insights(path_to_full_data):
 		images = []
 		
 		# Generate the images first
-		gdf_spread = gpd.read_file(path_to_gpkg)
-		companies = [x for x in gdf_spread['company'].unique().tolist() if x is not None]
+		company_codes = gdf_spread['company'].cat.codes
+
+		# One figure is reused for every frame
+		fig, ax = plt.subplots()
 		
-		for company in companies:
-			plot_data = gdf_spread[gdf_spread['company'] == company]
-			ax = plot_data.plot()
+		for i, company in enumerate(gdf_spread['company'].cat.categories):
+			plot_data = gdf_spread[company_codes == i]
+			if plot_data.empty:
+				continue
+
+			ax.clear()
+			plot_data.plot(ax=ax)
 
 			# Configure the plot
 			ax.set_title(company, fontdict={'fontsize': 18})
 			ax.set_xlim(77.40, 77.85)
 			ax.set_ylim(12.78, 13.25)
 
-			filename = f"{company.lower().replace(' ', '_')}.png"
-			plt.savefig(filename)
-
-			images.append(imageio.imread(filename))
-			os.remove(filename)
+			# Render straight to an RGB array rather than round-tripping through a PNG
+			fig.canvas.draw()
+			images.append(np.array(fig.canvas.buffer_rgba())[:, :, :3])
 		
+		plt.close(fig)
 		imageio.mimsave('company_spread.gif', images, duration=1)
 
-	gdf = gpd.read_file(path_to_full_data)
-	gdf_segments = gdf.drop_duplicates(subset=['segment_id', 'application_id'])
-	
-	# Remove the geometry column because it's useless here
-	gdf_segments = gdf_segments.drop(['geometry'], axis = 1)
+	# Only materialise the properties we actually use downstream
+	gdf = gpd.read_parquet(
+		path_to_full_data,
+		columns=[
+			'geometry',
+			'segment_id',
+			'street_name',
+			'application_id',
+			'application_submitted_date',
+			'application_email_id',
+			'ofc_cable_length',
+			'number_of_pits',
+			'segment_length',
+			'ward_name'
+		]
+	)
+
+	# Remove the geometry column first because it's useless here and would
+	# otherwise be carried through the deduplication
+	gdf_segments = gdf.drop(['geometry'], axis = 1)
+	gdf_segments = gdf_segments.groupby(['segment_id', 'application_id'], sort=False, dropna=False).head(1)
 
 	# Prepare for analysis
-	gdf_segments['company'] = gdf_segments.apply(lambda row: parse_email_domain(row), axis = 1)
-	gdf_segments['ofc_cable_length'] = gdf_segments['ofc_cable_length'].astype('float')
-	gdf_segments['segment_length'] = gdf_segments['segment_length'].astype('float')
-	gdf_segments['number_of_pits'] = gdf_segments['number_of_pits'].astype('int')
-	gdf_segments['application_submitted_time'] = gdf_segments.apply(
-		lambda row: datetime.strptime(row['application_submitted_date'], '%m/%d/%Y %I:%M:%S %p').isoformat(), 
-		axis = 1
-	)
+	gdf_segments['company'] = map_email_to_company(gdf_segments['application_email_id'])
+	gdf_segments = gdf_segments.astype({
+		'ofc_cable_length': 'float64',
+		'segment_length': 'float64'
+	})
+	# Strict cast first so a missing pit count raises instead of leaving the column as floats
+	gdf_segments['number_of_pits'] = pd.to_numeric(gdf_segments['number_of_pits'].astype('int64'), downcast='integer')
+	gdf_segments['application_submitted_time'] = pd.to_datetime(
+		gdf_segments['application_submitted_date'],
+		format=_SUBMITTED_FMT,
+		cache=True
+	).dt.strftime('%Y-%m-%dT%H:%M:%S')
 
 	gdf_segments = gdf_segments[[
 		'segment_id', 
@@ -140,16 +195,17 @@ def clean_data_derive_insights(path_to_full_data):
 
 	# A unique list of all the segments with the companies who made applications for them.
 	gdf_segments.to_csv('bbmp_ofc_segments.csv', index=False)
-	view_total_ofc_length = gdf_segments.groupby('company').sum()['ofc_cable_length']
+	view_total_ofc_length = gdf_segments.groupby('company', observed=True, sort=False)['ofc_cable_length'].sum()
 	print(view_total_ofc_length)
 	
 	# For the spread analysis, we discard duplicate portions of segments
 	gdf_spread = gdf.drop_duplicates(subset=['geometry', 'segment_id'])
-	gdf_spread['company'] = gdf_spread.apply(lambda row: parse_email_domain(row), axis = 1)
-	gdf_spread['application_submitted_time'] = gdf_spread.apply(
-        lambda row: datetime.strptime(row['application_submitted_date'], '%m/%d/%Y %I:%M:%S %p').isoformat(),
-        axis = 1
-    )
+	gdf_spread['company'] = map_email_to_company(gdf_spread['application_email_id'])
+	gdf_spread['application_submitted_time'] = pd.to_datetime(
+		gdf_spread['application_submitted_date'],
+		format=_SUBMITTED_FMT,
+		cache=True
+	).dt.strftime('%Y-%m-%dT%H:%M:%S')
 	
 	# Cleaning up the columns to avoid confusion
 	gdf_spread = gdf_spread[[
@@ -161,9 +217,66 @@ def clean_data_derive_insights(path_to_full_data):
 	]]
 	
 	# A segment differs from a segment portion. Each linestring in this file is a portion of a segment
-	gdf_spread.to_file('bbmp_ofc_segment_portions.gpkg', layer='ofc_segment_portions', driver="GPKG")
+	gdf_spread.to_file(
+		'bbmp_ofc_segment_portions.gpkg',
+		layer='ofc_segment_portions',
+		driver="GPKG",
+		engine="pyogrio"
+	)
+
+	generate_spread_gif(gdf_spread)
+
+async def fetch_ward_ofc_data(client, semaphore, url, ward):
+
+	"""
+	Fetches and saves the raw data for a single ward.
+	Returns the ward_id if the ward could not be fetched, so one bad ward doesn't sink the rest.
+	"""
+
+	zone_id = str(ward['zone_id'])
+	ward_id = str(ward['ward_id'])
+
+	try:
+		async with semaphore:
+			logging.info(f'Attempting ward_id {ward_id}')
+
+			data = f'{{\'zoneid\':\'{zone_id}\',\'wardid\':\'{ward_id}\',\'streetid\':\'0\'}}'
+			page = await client.post(url, content=data)
+
+		# Don't save an error page as if it were the ward's data
+		page.raise_for_status()
+
+		filename = f'data_raw/{ward_id}.txt'
+		with open(filename, 'w') as f:
+			f.write(page.text)
+	except Exception:
+		logging.exception(f'Failed ward_id {ward_id}')
+		return ward_id
+
+	logging.info(f"Saved ward_id {ward_id} to {filename}")
+
+async def fetch_all_ofc_data(zones_wards):
+
+	url = "http://bbmp.oasisweb.in/RoadHistory/CitizenView/CitizenViewDemo.aspx/GetOFCData"
+
+	# A handful of persistent connections to the single BBMP host, shared by all wards.
+	# Kept small because the server is slow enough as it is.
+	limits = httpx.Limits(max_connections=8, max_keepalive_connections=8)
+	transport = httpx.AsyncHTTPTransport(retries=3, limits=limits)
+	semaphore = asyncio.Semaphore(8)
+
+	# A single ward can take well over 30 seconds to come back, so there is no read timeout
+	timeout = httpx.Timeout(30.0, read=None)
+
+	async with httpx.AsyncClient(headers=headers, transport=transport, timeout=timeout) as client:
+		failed = await asyncio.gather(*[
+			fetch_ward_ofc_data(client, semaphore, url, ward) for ward in zones_wards
+		])
 
-	generate_spread_gif('bbmp_ofc_segment_portions.gpkg')
+	failed = [ward_id for ward_id in failed if ward_id is not None]
+	if failed:
+		logging.warning(f"Could not fetch ward_ids {', '.join(failed)}")
+		print("Could not fetch ward_ids ", failed)
 
 def get_all_ofc_data(zones_wards):
 
@@ -171,6 +284,7 @@ def get_all_ofc_data(zones_wards):
 	NOTE: Time consuming function.
 
 	Gets all of the raw data and logs progress along the way.
+	Wards are fetched concurrently over a pooled connection.
 	"""
 
 	logging.basicConfig(
@@ -180,24 +294,7 @@ def get_all_ofc_data(zones_wards):
 		level=logging.INFO
 	)
 
-	url = "http://bbmp.oasisweb.in/RoadHistory/CitizenView/CitizenViewDemo.aspx/GetOFCData"
-	session = requests.Session()
-	
-	for ward in zones_wards:
-		
-		zone_id = str(ward['zone_id'])
-		ward_id = str(ward['ward_id'])
-		
-		logging.info(f'Attempting ward_id {ward_id}')
-
-		data = f'{{\'zoneid\':\'{zone_id}\',\'wardid\':\'{ward_id}\',\'streetid\':\'0\'}}'
-		page = session.post(url, data=data, headers=headers)
-		
-		filename = f'data_raw/{ward_id}.txt'
-		with open(filename, 'w') as f:
-			f.write(page.text)
-		
-		logging.info(f"Saved ward_id {ward_id} to {filename}")
+	asyncio.run(fetch_all_ofc_data(zones_wards))
 		
 def get_wards():
 
@@ -207,13 +304,13 @@ def get_wards():
 
 	url = 'http://bbmp.oasisweb.in/RoadHistory/CitizenView/CitizenViewDemo.aspx/LoadWardByZone'
 	final_data = []	
+	session = get_session()
 
 	for i in range(1, 9):
 		print("Starting zone ", i)
-		page = requests.post(
+		page = session.post(
 			url, 
-			data=f"{{\'zoneid\':\'{str(i)}\'}}", 
-			headers=headers
+			data=f"{{\'zoneid\':\'{str(i)}\'}}"
 		)
 		page_json = json.loads(page.content)
 		data = json.loads(page_json['d'])
@@ -229,58 +326,70 @@ def get_wards():
 	
 	write_to_csv(final_data, 'zones_wards.csv')
 
-def create_behemoth_geojson(path_to_raw_data):
+def build_record(row):
 
 	"""
-	Parses the raw data into a single GeoJSON file.
+	Picks out the attributes of a single row of raw ward data.
+	"""
+
+	return {
+		"segment_id": row['SegmentID'],
+		"street_name": row['StreetName'],
+		"application_id": row['ApplicationId'],
+		"application_submitted_date": row['ApplicationsubmittedDate'],
+		"application_email_id": row['EmailId'],
+		"ofc_cable_length": row['OFCcableLength'],
+		"number_of_pits": row['NumberOfPits'],
+		"authorized_person": row['NameofAuthorizedPerson'],
+		"segment_length": row['SegmentLength'],
+		"ward_name": row['WardName'],
+		"zone_name": row['ZoneName']
+	}
+
+def create_behemoth_parquet(path_to_raw_data):
+
+	"""
+	Parses the raw data into a single GeoParquet file.
+
+	GeoParquet keeps coordinates as binary WKB in compressed columns,
+	so nothing is formatted to or parsed back from text on the way through.
+
+	Unlike a streamed GeoJSON, every ward's records and shapes are held in
+	memory until the frame is written, so peak memory grows with the whole
+	dataset rather than with a single ward.
 	"""
 	
-	features = []
-	files = os.listdir(path_to_raw_data)
-	
-	for f in files:
-		full_path = os.path.join(path_to_raw_data, f)
-		with open(full_path, 'r') as f:
-			data = json.loads(f.read())
-		
+	records = []
+	geometries = []
+
+	with os.scandir(path_to_raw_data) as entries:
+		for entry in entries:
+			if not entry.is_file():
+				continue
+
+			full_path = entry.path
+			
 			# Weird quirk where the value is a string
 			try:
-				rows = json.loads(data['d'])
+				data = orjson.loads(Path(full_path).read_bytes())
+				rows = orjson.loads(data['d'])
 			except:
 				print("Could not parse data for ", full_path)
 				continue
 		
-			for row in rows:
-				feature = {
-					"type": "Feature",
-					"properties": {
-						"segment_id": row['SegmentID'],
-						"street_name": row['StreetName'],
-						"application_id": row['ApplicationId'],
-						"application_submitted_date": row['ApplicationsubmittedDate'],
-						"application_email_id": row['EmailId'],
-						"ofc_cable_length": row['OFCcableLength'],
-						"number_of_pits": row['NumberOfPits'],
-						"authorized_person": row['NameofAuthorizedPerson'],
-						"segment_length": row['SegmentLength'],
-						"ward_name": row['WardName'],
-						"zone_name": row['ZoneName']
-					},
-					"geometry": {
-						"type": "LineString",
-						"coordinates": json.loads(row['Shape_Coordinates'])
-					}
-				}
-
-				features.append(feature)
-	
-	# Make GeoJSON complete
+			records.extend([build_record(row) for row in rows])
+			geometries.extend([LineString(orjson.loads(row['Shape_Coordinates'])) for row in rows])
 
-	final_geojson = {"type": "FeatureCollection", "features": features}
+	# The raw values can be strings in one ward and numbers in the next, which Arrow
+	# refuses to put in one column, so settle on a type per column before writing
+	df = pd.DataFrame(records)
+	numeric_columns = ['ofc_cable_length', 'number_of_pits', 'segment_length']
+	text_columns = [col for col in df.columns if col not in numeric_columns]
+	df[text_columns] = df[text_columns].apply(lambda col: col.where(col.isna(), col.astype(str)))
+	df[numeric_columns] = df[numeric_columns].apply(pd.to_numeric)
 
-	with open('bbmp_ofc_data.geojson', 'w') as f:
-		json.dump(final_geojson, f)
-	
+	gdf = gpd.GeoDataFrame(df, geometry=geometries, crs="EPSG:4326")
+	gdf.to_parquet('bbmp_ofc_data.parquet')
 
 def main():
 	
@@ -301,16 +410,16 @@ def main():
 	get_all_ofc_data(data)
 	
 	"""
-	Parse the data to create the behemoth GeoJSON
+	Parse the data to create the behemoth GeoParquet
 	"""
 	
-	create_behemoth_geojson('data_raw')
+	create_behemoth_parquet('data_raw')
 
 	"""
 	Clean further and derive insights
 	"""
 
-	clean_data_derive_insights("bbmp_ofc_data.geojson")	
+	clean_data_derive_insights("bbmp_ofc_data.parquet")	
 
 if __name__ == "__main__":
 	main()